@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# weather_server.py nằm ở thư mục gốc, không phải package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
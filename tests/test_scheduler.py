@@ -0,0 +1,207 @@
+import asyncio
+
+import weather_server as ws
+from weather_server import PRIORITY_CHEAP, PRIORITY_EXPENSIVE, PRIORITY_NORMAL, ToolScheduler
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_admits_up_to_global_limit_then_queues():
+    async def scenario():
+        s = ToolScheduler(max_concurrent=2, queue_timeout=0.05)
+        assert await s.acquire("a", PRIORITY_NORMAL)
+        assert await s.acquire("a", PRIORITY_NORMAL)
+        # Không còn slot: chờ hết QUEUE_TIMEOUT rồi báo bận
+        assert not await s.acquire("a", PRIORITY_NORMAL)
+        assert s._waiting == []
+        s.release("a", PRIORITY_NORMAL)
+        assert await s.acquire("a", PRIORITY_NORMAL)
+
+    run(scenario())
+
+
+def test_cheap_calls_are_granted_before_expensive_ones():
+    async def scenario():
+        s = ToolScheduler(max_concurrent=1, queue_timeout=1)
+        assert await s.acquire("a", PRIORITY_NORMAL)
+
+        order = []
+
+        async def call(priority, tag):
+            assert await s.acquire("b", priority)
+            order.append(tag)
+            s.release("b", priority)
+
+        tasks = [
+            asyncio.create_task(call(PRIORITY_EXPENSIVE, "history")),
+            asyncio.create_task(call(PRIORITY_NORMAL, "forecast")),
+            asyncio.create_task(call(PRIORITY_CHEAP, "geocode")),
+        ]
+        await asyncio.sleep(0)
+        s.release("a", PRIORITY_NORMAL)
+        await asyncio.gather(*tasks)
+        assert order == ["geocode", "forecast", "history"]
+
+    run(scenario())
+
+
+def test_expensive_cap_does_not_block_cheap_calls():
+    async def scenario():
+        s = ToolScheduler(max_concurrent=4, max_expensive=1, queue_timeout=0.05)
+        assert await s.acquire("a", PRIORITY_EXPENSIVE)
+        assert not await s.acquire("a", PRIORITY_EXPENSIVE)
+        assert await s.acquire("a", PRIORITY_CHEAP)
+
+    run(scenario())
+
+
+def test_less_busy_session_is_served_first():
+    async def scenario():
+        s = ToolScheduler(max_concurrent=2, queue_timeout=1)
+        assert await s.acquire("bursty", PRIORITY_NORMAL)
+        assert await s.acquire("bursty", PRIORITY_NORMAL)
+
+        order = []
+
+        async def call(session):
+            assert await s.acquire(session, PRIORITY_NORMAL)
+            order.append(session)
+
+        tasks = [
+            asyncio.create_task(call("bursty")),
+            asyncio.create_task(call("quiet")),
+        ]
+        await asyncio.sleep(0)
+        s.release("bursty", PRIORITY_NORMAL)
+        await asyncio.sleep(0.01)
+        assert order == ["quiet"]
+        s.release("bursty", PRIORITY_NORMAL)
+        await asyncio.gather(*tasks)
+        assert order == ["quiet", "bursty"]
+
+    run(scenario())
+
+
+def test_full_queue_is_rejected_immediately():
+    async def scenario():
+        s = ToolScheduler(max_concurrent=1, max_queued=1, queue_timeout=1)
+        assert await s.acquire("a", PRIORITY_NORMAL)
+        waiter = asyncio.create_task(s.acquire("a", PRIORITY_NORMAL))
+        await asyncio.sleep(0)
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        assert not await s.acquire("a", PRIORITY_NORMAL)
+        assert loop.time() - started < 0.5
+
+        s.release("a", PRIORITY_NORMAL)
+        assert await waiter
+
+    run(scenario())
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def scenario():
+        s = ToolScheduler(max_concurrent=1, queue_timeout=5)
+        assert await s.acquire("a", PRIORITY_NORMAL)
+        waiter = asyncio.create_task(s.acquire("b", PRIORITY_NORMAL))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+        assert s._waiting == []
+        assert s._queued_by_session == {}
+        s.release("a", PRIORITY_NORMAL)
+        assert s._running == 0
+
+    run(scenario())
+
+
+def test_scheduled_tool_releases_slot_when_cancelled(monkeypatch):
+    s = ToolScheduler(max_concurrent=1, queue_timeout=0.05)
+    monkeypatch.setattr(ws, "scheduler", s)
+
+    @ws.scheduled(PRIORITY_NORMAL)
+    async def slow_tool() -> str:
+        await asyncio.sleep(10)
+        return "done"
+
+    @ws.scheduled(PRIORITY_NORMAL)
+    async def fast_tool() -> str:
+        return "done"
+
+    async def scenario():
+        task = asyncio.create_task(slow_tool())
+        await asyncio.sleep(0)
+        assert s._running == 1
+        assert (await fast_tool()).startswith("⏳ Server đang quá tải")
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert s._running == 0
+        assert await fast_tool() == "done"
+
+    run(scenario())
+
+
+async def _fill_with_expensive(s, session, count):
+    """Tạo `count` lời gọi Archive API; trả về (task, số lời gọi bị từ chối ngay)."""
+    tasks = [asyncio.create_task(s.acquire(session, PRIORITY_EXPENSIVE)) for _ in range(count)]
+    await asyncio.sleep(0)
+    rejected = sum(1 for t in tasks if t.done() and not t.result())
+    return tasks, rejected
+
+
+async def _cancel_all(tasks):
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def test_cheap_call_is_admitted_while_queue_is_full_of_expensive_calls():
+    async def scenario():
+        # Tình huống gốc: 4 lời gọi lịch sử đang chạy, 64 lời gọi đang chờ
+        s = ToolScheduler(max_queued_expensive=ws.MAX_QUEUED_CALLS)
+        tasks, rejected = await _fill_with_expensive(s, "bursty", 4 + 64)
+        assert rejected == 0
+        assert s._running == 4
+        assert len(s._waiting) == ws.MAX_QUEUED_CALLS
+
+        assert await asyncio.wait_for(s.acquire("other", PRIORITY_CHEAP), 0.1)
+        assert await asyncio.wait_for(s.acquire("other", PRIORITY_NORMAL), 0.1)
+        await _cancel_all(tasks)
+
+    run(scenario())
+
+
+def test_full_queue_evicts_lowest_priority_waiter():
+    async def scenario():
+        s = ToolScheduler(max_concurrent=1, max_queued=1, queue_timeout=1)
+        assert await s.acquire("a", PRIORITY_NORMAL)
+        expensive = asyncio.create_task(s.acquire("bursty", PRIORITY_EXPENSIVE))
+        await asyncio.sleep(0)
+
+        cheap = asyncio.create_task(s.acquire("other", PRIORITY_CHEAP))
+        await asyncio.sleep(0)
+        assert await expensive is False
+
+        s.release("a", PRIORITY_NORMAL)
+        assert await cheap is True
+        assert s._waiting == []
+
+    run(scenario())
+
+
+def test_expensive_waiters_have_their_own_queue_bound():
+    async def scenario():
+        s = ToolScheduler()
+        count = ws.MAX_CONCURRENT_EXPENSIVE + ws.MAX_QUEUED_EXPENSIVE + 5
+        tasks, rejected = await _fill_with_expensive(s, "bursty", count)
+        assert rejected == 5
+        assert s._queued_expensive == ws.MAX_QUEUED_EXPENSIVE
+        await _cancel_all(tasks)
+        assert s._queued_expensive == 0
+
+    run(scenario())
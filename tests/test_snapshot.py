@@ -0,0 +1,287 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+import weather_server as ws
+from weather_server import SnapshotTransport, WeatherSnapshot
+
+ARCHIVE_URL = "https://archive-api.open-meteo.com/v1/archive"
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+HANOI = {"latitude": 21.0285, "longitude": 105.8542}
+
+
+def archive_url(start: str, end: str, **coords) -> httpx.URL:
+    params = {**HANOI, **coords, "start_date": start, "end_date": end,
+              "daily": ["weather_code", "temperature_2m_max"], "timezone": "auto"}
+    return httpx.URL(ARCHIVE_URL, params=params)
+
+
+def current_url(**coords) -> httpx.URL:
+    params = {**HANOI, **coords, "current": ["temperature_2m"], "timezone": "auto"}
+    return httpx.URL(FORECAST_URL, params=params)
+
+
+def archive_body(days: list[str]) -> bytes:
+    return json.dumps({
+        "daily": {
+            "time": days,
+            "weather_code": [1] * len(days),
+            "temperature_2m_max": [20 + i for i in range(len(days))],
+        },
+        "daily_units": {"temperature_2m_max": "°C"},
+    }).encode()
+
+
+DECEMBER = [f"2024-12-0{d}" for d in range(1, 8)]
+
+
+@pytest.fixture
+def recorded(tmp_path):
+    path = tmp_path / "snap.bin"
+    snap = WeatherSnapshot(str(path), writable=True)
+    snap.record(archive_url("2024-12-01", "2024-12-07"), 200, "application/json",
+                archive_body(DECEMBER))
+    snap.record(current_url(), 200, "application/json",
+                json.dumps({"current": {"temperature_2m": 25}}).encode())
+    snap.close()
+    return path
+
+
+def test_round_trip_after_reopen(recorded):
+    snap = WeatherSnapshot(str(recorded))
+    assert len(snap) == 2
+
+    rec = snap.lookup(archive_url("2024-12-01", "2024-12-07"))
+    assert rec["status"] == 200
+    assert json.loads(rec["body"])["daily"]["time"] == DECEMBER
+
+    rec = snap.lookup(current_url(latitude=21.1, longitude=105.9))
+    assert json.loads(rec["body"])["current"]["temperature_2m"] == 25
+    snap.close()
+
+
+def test_sub_range_is_trimmed_to_requested_days(recorded):
+    snap = WeatherSnapshot(str(recorded))
+    rec = snap.lookup(archive_url("2024-12-02", "2024-12-03"))
+    daily = json.loads(rec["body"])["daily"]
+    assert daily["time"] == ["2024-12-02", "2024-12-03"]
+    assert daily["temperature_2m_max"] == [21, 22]
+    snap.close()
+
+
+@pytest.mark.parametrize("start, end", [
+    ("2019-03-01", "2019-03-31"),   # khoảng thời gian khác hẳn
+    ("2024-11-30", "2024-12-03"),   # bắt đầu trước bản ghi
+    ("2024-12-05", "2024-12-10"),   # kết thúc sau bản ghi
+])
+def test_uncovered_date_range_is_rejected(recorded, start, end):
+    snap = WeatherSnapshot(str(recorded))
+    assert snap.lookup(archive_url(start, end)) is None
+    snap.close()
+
+
+def test_distant_coordinates_are_rejected(recorded):
+    snap = WeatherSnapshot(str(recorded))
+    # TP. Hồ Chí Minh cách Hà Nội hơn 1000 km
+    assert snap.lookup(current_url(latitude=10.8231, longitude=106.6297)) is None
+    snap.close()
+
+
+def test_fallback_age_limit(recorded):
+    snap = WeatherSnapshot(str(recorded))
+    for entries in snap._entries.values():
+        for entry in entries:
+            entry["t0"] -= 1  # giả lập bản ghi cũ một ngày
+    assert snap.lookup(current_url(), max_age_hours=3) is None
+    assert snap.lookup(current_url()) is not None
+    snap.close()
+
+
+def test_unflushed_records_are_lost_but_file_stays_valid(recorded):
+    snap = WeatherSnapshot(str(recorded), writable=True)
+    snap.record(archive_url("2023-01-01", "2023-01-02"), 200, "application/json",
+                archive_body(["2023-01-01", "2023-01-02"]))
+    # Không gọi close(): giống tiến trình bị dừng trước khi flush index
+    reopened = WeatherSnapshot(str(recorded))
+    assert len(reopened) == 2
+    assert reopened.lookup(archive_url("2023-01-01", "2023-01-02")) is None
+    reopened.close()
+    snap.close()
+
+
+def test_index_is_flushed_periodically(tmp_path, monkeypatch):
+    monkeypatch.setattr(ws, "SNAPSHOT_FLUSH_EVERY", 2)
+    monkeypatch.setattr(ws, "SNAPSHOT_FLUSH_SECONDS", 60)
+    path = tmp_path / "snap.bin"
+    snap = WeatherSnapshot(str(path), writable=True)
+    for lat in (1.0, 2.0, 3.0):
+        snap.record(current_url(latitude=lat), 200, "application/json", b"{}")
+    before_close = WeatherSnapshot(str(path))
+    assert len(before_close) == 2
+    before_close.close()
+
+    snap.close()
+    after_close = WeatherSnapshot(str(path))
+    assert len(after_close) == 3
+    after_close.close()
+
+
+def test_index_is_flushed_shortly_after_recording(tmp_path, monkeypatch):
+    # Server bị dừng đột ngột (không chạy atexit) vẫn giữ được các record cũ
+    monkeypatch.setattr(ws, "SNAPSHOT_FLUSH_SECONDS", 0.05)
+    path = tmp_path / "snap.bin"
+    snap = WeatherSnapshot(str(path), writable=True)
+    snap.record(current_url(), 200, "application/json", b"{}")
+    time.sleep(0.3)
+
+    reopened = WeatherSnapshot(str(path))
+    assert len(reopened) == 1
+    reopened.close()
+    snap.close()
+
+
+def test_close_compacts_index_segments(tmp_path, monkeypatch):
+    monkeypatch.setattr(ws, "SNAPSHOT_FLUSH_EVERY", 1)
+    path = tmp_path / "snap.bin"
+    snap = WeatherSnapshot(str(path), writable=True)
+    for i in range(200):
+        snap.record(current_url(latitude=i / 10), 200, "application/json", b"{}")
+    assert snap._segments == 200
+    size_before = path.stat().st_size
+    snap.close()
+
+    reopened = WeatherSnapshot(str(path))
+    assert len(reopened) == 200
+    assert reopened._segments == 1
+    assert path.stat().st_size < size_before
+    assert json.loads(reopened.lookup(current_url(latitude=19.9))["body"]) == {}
+    reopened.close()
+
+
+def test_second_writer_is_read_only(tmp_path):
+    path = tmp_path / "snap.bin"
+    first = WeatherSnapshot(str(path), writable=True)
+    second = WeatherSnapshot(str(path), writable=True)
+    assert first.writable
+    assert not second.writable
+
+    first.record(current_url(latitude=1.0), 200, "application/json", b"{}")
+    second.record(current_url(latitude=2.0), 200, "application/json", b"{}")
+    second.close()
+    first.close()
+
+    reopened = WeatherSnapshot(str(path), writable=True)
+    assert reopened.writable  # khóa được nhả khi close()
+    assert len(reopened) == 1
+    reopened.close()
+
+
+@pytest.mark.parametrize("content", [
+    b"WX",
+    ws._SNAPSHOT_HEADER.pack(b"NOTSNAP!", 0, 0),
+    ws._SNAPSHOT_HEADER.pack(ws._SNAPSHOT_MAGIC, 24, 4) + b"junk",
+    ws._SNAPSHOT_HEADER.pack(ws._SNAPSHOT_MAGIC, 24, 1000),
+])
+def test_corrupt_file_raises_value_error(tmp_path, content):
+    path = tmp_path / "snap.bin"
+    path.write_bytes(content)
+    with pytest.raises(ValueError, match="File snapshot không hợp lệ"):
+        WeatherSnapshot(str(path))
+
+
+def test_replay_transport_serves_snapshot_and_rejects_misses(recorded):
+    snap = WeatherSnapshot(str(recorded))
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=SnapshotTransport(snap, "replay")) as client:
+            resp = await client.get(archive_url("2024-12-01", "2024-12-02"))
+            assert json.loads(resp.text)["daily"]["time"] == ["2024-12-01", "2024-12-02"]
+            with pytest.raises(httpx.ConnectError):
+                await client.get(archive_url("2019-03-01", "2019-03-31"))
+
+    asyncio.run(scenario())
+    snap.close()
+
+
+def test_fallback_transport_records_then_serves_when_upstream_is_down(tmp_path):
+    snap = WeatherSnapshot(str(tmp_path / "snap.bin"), writable=True)
+    upstream_up = True
+
+    def upstream(request):
+        if not upstream_up:
+            raise httpx.ConnectError("down", request=request)
+        return httpx.Response(200, json={"current": {"temperature_2m": 30}})
+
+    transport = SnapshotTransport(snap, "fallback")
+    transport._upstream = httpx.AsyncClient(transport=httpx.MockTransport(upstream))
+
+    async def scenario():
+        nonlocal upstream_up
+        async with httpx.AsyncClient(transport=transport) as client:
+            assert (await client.get(current_url())).json()["current"]["temperature_2m"] == 30
+            upstream_up = False
+            assert (await client.get(current_url())).json()["current"]["temperature_2m"] == 30
+            with pytest.raises(httpx.ConnectError):
+                await client.get(current_url(latitude=10.8231, longitude=106.6297))
+
+    asyncio.run(scenario())
+    snap.close()
+
+
+def test_snapshot_write_failure_does_not_fail_upstream_call(tmp_path):
+    snap = WeatherSnapshot(str(tmp_path / "snap.bin"), writable=True)
+    snap.path = str(tmp_path / "missing-dir" / "snap.bin")  # thư mục không tồn tại
+    transport = SnapshotTransport(snap, "record")
+    transport._upstream = httpx.AsyncClient(transport=httpx.MockTransport(
+        lambda request: httpx.Response(200, json={"current": {"temperature_2m": 30}})
+    ))
+
+    async def scenario():
+        async with httpx.AsyncClient(transport=transport) as client:
+            resp = await client.get(current_url())
+            assert resp.status_code == 200
+            assert resp.json()["current"]["temperature_2m"] == 30
+
+    asyncio.run(scenario())
+    snap.close()
+
+
+def test_unwritable_location_opens_read_only(tmp_path):
+    snap = WeatherSnapshot(str(tmp_path / "missing-dir" / "snap.bin"), writable=True)
+    assert not snap.writable
+    snap.close()
+
+
+def test_upstream_requests_honour_proxy_environment(tmp_path, monkeypatch):
+    seen = []
+
+    async def fake_proxy(reader, writer):
+        seen.append((await reader.readline()).decode())
+        while (await reader.readline()) not in (b"\r\n", b""):
+            pass
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+            b"Content-Length: 2\r\nConnection: close\r\n\r\n{}"
+        )
+        await writer.drain()
+        writer.close()
+
+    async def scenario():
+        server = await asyncio.start_server(fake_proxy, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        monkeypatch.setenv("HTTP_PROXY", f"http://127.0.0.1:{port}")
+        for name in ("NO_PROXY", "no_proxy", "ALL_PROXY", "all_proxy"):
+            monkeypatch.delenv(name, raising=False)
+
+        snap = WeatherSnapshot(str(tmp_path / "snap.bin"), writable=True)
+        async with server:
+            async with httpx.AsyncClient(transport=SnapshotTransport(snap, "record")) as client:
+                resp = await client.get("http://api.open-meteo.invalid/v1/forecast")
+        snap.close()
+        assert resp.status_code == 200
+        assert seen and "http://api.open-meteo.invalid/v1/forecast" in seen[0]
+
+    asyncio.run(scenario())
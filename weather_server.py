@@ -11,9 +11,34 @@ Các tool cung cấp:
   - get_forecast       : Dự báo thời tiết tối đa 7 ngày
 """
 
+import asyncio
+import atexit
+import functools
+import itertools
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import defaultdict
+from datetime import date
+from pathlib import Path
+from urllib.parse import urlencode
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
 import httpx
 from mcp.server.fastmcp import FastMCP
 
+logger = logging.getLogger(__name__)
+
 # ─── Khởi tạo MCP server ───────────────────────────────────────────────────
 mcp = FastMCP(
     name="weather",
@@ -80,8 +105,676 @@ def validate_coordinates(latitude: float, longitude: float) -> str | None:
     return None
 
 
+# ─── Bộ điều phối tool (admission control) ─────────────────────────────────
+# Mức ưu tiên: số nhỏ hơn được phục vụ trước khi có slot trống.
+PRIORITY_CHEAP = 0      # geocode_city
+PRIORITY_NORMAL = 1     # thời tiết hiện tại, dự báo, chất lượng không khí
+PRIORITY_EXPENSIVE = 2  # get_historical_weather (Archive API)
+
+MAX_CONCURRENT_CALLS = 16            # Tổng số tool chạy đồng thời
+MAX_CONCURRENT_EXPENSIVE = 4         # Số lần gọi Archive API đồng thời
+MAX_QUEUED_CALLS = 64                # Độ dài tối đa của hàng đợi
+MAX_QUEUED_EXPENSIVE = 16            # Số lần gọi Archive API được chờ trong hàng đợi
+# Với transport stdio mỗi tiến trình chỉ có một session, nên giới hạn theo
+# client mặc định bằng giới hạn toàn cục. Hạ các giá trị này khi chạy server
+# với transport nhiều session (SSE / streamable HTTP).
+MAX_CONCURRENT_PER_SESSION = MAX_CONCURRENT_CALLS
+MAX_QUEUED_PER_SESSION = MAX_QUEUED_CALLS
+QUEUE_TIMEOUT_SECONDS = 5.0          # Thời gian chờ tối đa trước khi báo bận
+
+
+class ToolScheduler:
+    """
+    Giới hạn số tool chạy đồng thời (toàn cục, theo client, theo mức ưu tiên)
+    và xếp hàng có giới hạn. Khi có slot trống, lời gọi rẻ hơn được cấp trước;
+    cùng mức ưu tiên thì client đang chạy ít tool hơn được cấp trước.
+    Khi hàng đợi đầy, lời gọi đắt nhất (mới nhất) đang chờ bị loại để nhường
+    chỗ cho lời gọi rẻ hơn.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = MAX_CONCURRENT_CALLS,
+        max_per_session: int = MAX_CONCURRENT_PER_SESSION,
+        max_expensive: int = MAX_CONCURRENT_EXPENSIVE,
+        max_queued: int = MAX_QUEUED_CALLS,
+        max_queued_expensive: int = MAX_QUEUED_EXPENSIVE,
+        max_queued_per_session: int = MAX_QUEUED_PER_SESSION,
+        queue_timeout: float = QUEUE_TIMEOUT_SECONDS,
+    ) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_per_session = max_per_session
+        self.max_expensive = max_expensive
+        self.max_queued = max_queued
+        self.max_queued_expensive = max_queued_expensive
+        self.max_queued_per_session = max_queued_per_session
+        self.queue_timeout = queue_timeout
+
+        self._running = 0
+        self._running_expensive = 0
+        self._running_by_session: dict[str, int] = defaultdict(int)
+        self._queued_by_session: dict[str, int] = defaultdict(int)
+        self._queued_expensive = 0
+        # Mỗi phần tử: [priority, seq, session, future]; future nhận True khi
+        # được cấp slot, False khi bị loại khỏi hàng đợi
+        self._waiting: list[list] = []
+        self._seq = itertools.count()
+
+    def _can_start(self, session: str, priority: int) -> bool:
+        if self._running >= self.max_concurrent:
+            return False
+        if self._running_by_session.get(session, 0) >= self.max_per_session:
+            return False
+        if priority >= PRIORITY_EXPENSIVE and self._running_expensive >= self.max_expensive:
+            return False
+        return True
+
+    def _start(self, session: str, priority: int) -> None:
+        self._running += 1
+        self._running_by_session[session] += 1
+        if priority >= PRIORITY_EXPENSIVE:
+            self._running_expensive += 1
+
+    def _enqueue(self, entry: list) -> None:
+        self._waiting.append(entry)
+        self._queued_by_session[entry[2]] += 1
+        if entry[0] >= PRIORITY_EXPENSIVE:
+            self._queued_expensive += 1
+
+    def _dequeue(self, entry: list) -> None:
+        self._waiting.remove(entry)
+        session = entry[2]
+        self._queued_by_session[session] -= 1
+        if not self._queued_by_session[session]:
+            del self._queued_by_session[session]
+        if entry[0] >= PRIORITY_EXPENSIVE:
+            self._queued_expensive -= 1
+
+    def _has_waiter_ahead(self, priority: int) -> bool:
+        """Có lời gọi đang chờ cùng hoặc cao hơn mức ưu tiên và chạy được ngay không."""
+        return any(
+            e[0] <= priority and self._can_start(e[2], e[0]) for e in self._waiting
+        )
+
+    def _make_room(self, priority: int) -> bool:
+        """
+        Khi hàng đợi đầy, loại lời gọi có mức ưu tiên thấp nhất (mới nhất)
+        nếu nó kém hơn lời gọi mới. Trả về False nếu không loại được.
+        """
+        victim = max(self._waiting, key=lambda e: (e[0], e[1]))
+        if victim[0] <= priority:
+            return False
+        self._dequeue(victim)
+        victim[3].set_result(False)
+        return True
+
+    def _dispatch(self) -> None:
+        """Cấp slot cho các lời gọi đang chờ theo thứ tự ưu tiên."""
+        while self._waiting and self._running < self.max_concurrent:
+            candidates = sorted(
+                self._waiting,
+                key=lambda e: (e[0], self._running_by_session.get(e[2], 0), e[1]),
+            )
+            for entry in candidates:
+                priority, _, session, fut = entry
+                if self._can_start(session, priority):
+                    self._dequeue(entry)
+                    self._start(session, priority)
+                    fut.set_result(True)
+                    break
+            else:
+                return
+
+    async def acquire(self, session: str, priority: int) -> bool:
+        """
+        Chờ tới lượt chạy tool. Trả về False nếu server quá tải
+        (hàng đợi đầy, bị loại khỏi hàng đợi hoặc chờ quá QUEUE_TIMEOUT_SECONDS).
+        """
+        if self._can_start(session, priority) and not self._has_waiter_ahead(priority):
+            self._start(session, priority)
+            return True
+
+        if self._queued_by_session.get(session, 0) >= self.max_queued_per_session:
+            return False
+        if priority >= PRIORITY_EXPENSIVE and self._queued_expensive >= self.max_queued_expensive:
+            return False
+        if len(self._waiting) >= self.max_queued and not self._make_room(priority):
+            return False
+
+        fut = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._seq), session, fut]
+        self._enqueue(entry)
+        self._dispatch()
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if fut.done():
+                return fut.result()
+            self._dequeue(entry)
+            fut.cancel()
+            return False
+        except BaseException:
+            # Lời gọi bị hủy: trả lại slot nếu đã được cấp
+            if fut.done():
+                if fut.result():
+                    self.release(session, priority)
+            else:
+                self._dequeue(entry)
+                fut.cancel()
+            raise
+
+    def release(self, session: str, priority: int) -> None:
+        """Trả lại slot sau khi tool chạy xong và cấp cho lời gọi tiếp theo."""
+        self._running -= 1
+        self._running_by_session[session] -= 1
+        if not self._running_by_session[session]:
+            del self._running_by_session[session]
+        if priority >= PRIORITY_EXPENSIVE:
+            self._running_expensive -= 1
+        self._dispatch()
+
+
+scheduler = ToolScheduler()
+
+
+def current_session_key() -> str:
+    """Khóa nhận diện client của request hiện tại (mỗi MCP session một khóa)."""
+    try:
+        session = mcp.get_context().request_context.session
+    except (LookupError, ValueError):
+        return "local"
+    return f"session-{id(session)}"
+
+
+def scheduled(priority: int):
+    """
+    Decorator đặt tool sau ToolScheduler. Khi quá tải, trả về ngay thông báo
+    "server bận" thay vì để lời gọi xếp hàng vô hạn.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            session = current_session_key()
+            if not await scheduler.acquire(session, priority):
+                return (
+                    f"⏳ Server đang quá tải, không thể xử lý '{func.__name__}' lúc này.\n"
+                    f"   Vui lòng thử lại sau vài giây."
+                )
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                scheduler.release(session, priority)
+        return wrapper
+    return decorator
+
+
+# ─── Snapshot: ghi lại / phát lại dữ liệu Open-Meteo ───────────────────────
+# WEATHER_SNAPSHOT_MODE:
+#   off      : gọi Open-Meteo trực tiếp (mặc định)
+#   record   : gọi Open-Meteo và ghi mọi response vào snapshot
+#   replay   : chỉ đọc từ snapshot, không truy cập mạng
+#   fallback : gọi Open-Meteo và ghi snapshot; khi upstream lỗi thì đọc snapshot
+SNAPSHOT_MODES = ("off", "record", "replay", "fallback")
+SNAPSHOT_MODE = os.environ.get("WEATHER_SNAPSHOT_MODE", "off").strip().lower()
+# Đường dẫn tương đối tính từ thư mục chứa weather_server.py, không phải thư mục
+# làm việc của host (Claude Desktop, Cline… thường khởi động server ở nơi khác)
+SNAPSHOT_PATH = str(
+    Path(__file__).resolve().parent
+    / os.environ.get("WEATHER_SNAPSHOT_PATH", "weather_snapshot.bin")
+)
+SNAPSHOT_MAX_DISTANCE_KM = 50.0         # Bán kính tối đa khi ghép tọa độ gần nhất
+SNAPSHOT_FALLBACK_MAX_AGE_HOURS = 3.0   # Tuổi tối đa của dữ liệu hiện tại/dự báo khi fallback
+SNAPSHOT_FLUSH_EVERY = 100              # Ghi index sau mỗi N record ...
+SNAPSHOT_FLUSH_SECONDS = 2.0            # ... hoặc chậm nhất N giây sau record đầu tiên chưa ghi
+
+_SNAPSHOT_MAGIC = b"WXSNAP03"
+_SNAPSHOT_HEADER = struct.Struct("<8sQQ")  # magic, offset + độ dài đoạn index mới nhất
+# Tham số dùng để ghép gần đúng, không thuộc khóa tra cứu
+_SNAPSHOT_MATCH_PARAMS = ("latitude", "longitude", "start_date", "end_date")
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Khoảng cách đường tròn lớn giữa hai tọa độ (km)."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(a))
+
+
+def _days_now() -> float:
+    """Thời điểm hiện tại tính bằng ngày, cùng thang với date.toordinal()."""
+    return time.time() / 86400 + date(1970, 1, 1).toordinal()
+
+
+def describe_request(
+    url: httpx.URL,
+) -> tuple[str, float | None, float | None, tuple[date, date] | None]:
+    """
+    Tách request thành (khóa, lat, lon, khoảng ngày).
+    Khóa gồm endpoint và các tham số còn lại; khoảng ngày là
+    (start_date, end_date) với Archive API, None với các API khác.
+    """
+    params = dict(url.params.multi_items())
+    span = None
+    if "start_date" in params:
+        try:
+            start = date.fromisoformat(params["start_date"])
+            span = (start, date.fromisoformat(params.get("end_date", params["start_date"])))
+        except ValueError:
+            span = None
+
+    # Ngày không đọc được thì giữ nguyên trong khóa để chỉ khớp chính xác
+    match_params = _SNAPSHOT_MATCH_PARAMS if span else ("latitude", "longitude")
+    rest = sorted(
+        (k, v.lower() if k == "name" else v)
+        for k, v in url.params.multi_items()
+        if k not in match_params
+    )
+    key = f"{url.host}{url.path}?{urlencode(rest)}"
+
+    lat = float(params["latitude"]) if "latitude" in params else None
+    lon = float(params["longitude"]) if "longitude" in params else None
+    return key, lat, lon, span
+
+
+def trim_daily(body: str, start: date, end: date) -> str:
+    """Chỉ giữ các ngày trong [start, end] của mảng daily trong response."""
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return body
+    daily = data.get("daily") if isinstance(data, dict) else None
+    if not isinstance(daily, dict) or not isinstance(daily.get("time"), list):
+        return body
+
+    times = daily["time"]
+    lo, hi = start.isoformat(), end.isoformat()
+    keep = [i for i, d in enumerate(times) if lo <= str(d)[:10] <= hi]
+    data["daily"] = {
+        k: [v[i] for i in keep] if isinstance(v, list) and len(v) == len(times) else v
+        for k, v in daily.items()
+    }
+    return json.dumps(data, ensure_ascii=False)
+
+
+class WeatherSnapshot:
+    """
+    File snapshot chứa các response đã ghi, dạng:
+        [header][record zlib]...[đoạn index zlib][record zlib]...[đoạn index zlib]
+    Mỗi lần flush chỉ nối thêm một đoạn index chứa các record mới và trỏ tới
+    đoạn trước đó; header trỏ tới đoạn mới nhất và chỉ được ghi đè sau khi
+    đoạn đó đã nằm trên đĩa, nên file luôn đọc được kể cả khi tiến trình bị
+    dừng giữa chừng (chỉ mất các record chưa được flush). close() gộp lại
+    thành một đoạn index duy nhất. Record chỉ được giải nén khi khớp, đọc qua mmap.
+
+    Chỉ một tiến trình được ghi vào một file snapshot (khóa "<path>.lock");
+    các tiến trình khác mở snapshot ở chế độ chỉ đọc.
+    """
+
+    def __init__(self, path: str, writable: bool = False) -> None:
+        self.path = path
+        self._lock_file = None
+        self._entries: dict[str, list[dict]] = {}
+        self._unindexed: list[dict] = []
+        self._head = (0, 0)  # offset, độ dài đoạn index mới nhất
+        self._segments = 0
+        self._flush_timer: threading.Timer | None = None
+        self._lock = threading.Lock()
+        self._file = None
+        self._mmap: mmap.mmap | None = None
+        if writable:
+            try:
+                if not self._acquire_writer_lock():
+                    logger.warning(
+                        "Snapshot %s đang được tiến trình khác ghi; "
+                        "tiến trình này chỉ đọc snapshot.", path,
+                    )
+            except OSError as exc:
+                logger.warning("Không mở được snapshot %s để ghi, chỉ đọc: %s", path, exc)
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            try:
+                self._load()
+            except ValueError:
+                self._release_writer_lock()
+                raise
+
+    @property
+    def writable(self) -> bool:
+        return self._lock_file is not None
+
+    def _acquire_writer_lock(self) -> bool:
+        """Giữ khóa ghi ở mức hệ điều hành cho tới khi close() hoặc tiến trình kết thúc."""
+        lock_file = open(f"{self.path}.lock", "a+b")
+        try:
+            if os.name == "nt":
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _release_writer_lock(self) -> None:
+        # Đóng file là nhả khóa (cả flock lẫn msvcrt.locking)
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self._entries.values())
+
+    def _load(self) -> None:
+        invalid = f"File snapshot không hợp lệ: {self.path}"
+        size = os.path.getsize(self.path)
+        if size < _SNAPSHOT_HEADER.size:
+            raise ValueError(invalid)
+
+        self._open_map()
+        magic, off, length = _SNAPSHOT_HEADER.unpack(self._mmap[:_SNAPSHOT_HEADER.size])
+        if magic != _SNAPSHOT_MAGIC:
+            self._close_map()
+            raise ValueError(invalid)
+        self._head = (off, length)
+
+        # Đi ngược chuỗi đoạn index, từ mới nhất về cũ nhất
+        segments = []
+        try:
+            while length:
+                if off < _SNAPSHOT_HEADER.size or off + length > size:
+                    raise ValueError(invalid)
+                segment = json.loads(zlib.decompress(self._mmap[off:off + length]))
+                segments.append(segment["entries"])
+                prev_off, prev_length = segment["prev"] or (0, 0)
+                if prev_length and prev_off >= off:
+                    raise ValueError(invalid)
+                off, length = prev_off, prev_length
+        except (zlib.error, ValueError, KeyError, TypeError) as exc:
+            self._close_map()
+            raise ValueError(invalid) from exc
+
+        for entries in reversed(segments):
+            for entry in entries:
+                self._entries.setdefault(entry["key"], []).append(entry)
+        self._segments = len(segments)
+
+    def _open_map(self) -> None:
+        self._file = open(self.path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_map(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = self._file = None
+
+    def lookup(self, url: httpx.URL, max_age_hours: float | None = None) -> dict | None:
+        """
+        Tìm record cùng endpoint và tham số, gần tọa độ nhất
+        (trong SNAPSHOT_MAX_DISTANCE_KM). Với Archive API, record phải phủ
+        trọn khoảng ngày được yêu cầu và chỉ trả về các ngày đó; với các API
+        khác, chọn record mới nhất, không cũ hơn max_age_hours nếu có.
+        """
+        key, lat, lon, span = describe_request(url)
+        now = _days_now()
+        best, best_score = None, None
+        for entry in self._entries.get(key, ()):
+            if lat is None or entry["lat"] is None:
+                distance = 0.0
+            else:
+                distance = haversine_km(lat, lon, entry["lat"], entry["lon"])
+                if distance > SNAPSHOT_MAX_DISTANCE_KM:
+                    continue
+
+            if span is not None:
+                start, end = span[0].toordinal(), span[1].toordinal()
+                if entry["t0"] > start or entry["t1"] < end:
+                    continue
+                gap = (entry["t1"] - entry["t0"]) - (end - start)
+            else:
+                gap = now - entry["t0"]
+                # Kết quả geocode (không có tọa độ) không bị giới hạn tuổi
+                if max_age_hours is not None and lat is not None and gap * 24 > max_age_hours:
+                    continue
+
+            score = (distance, gap)
+            if best_score is None or score < best_score:
+                best, best_score = entry, score
+        if best is None:
+            return None
+
+        end_offset = best["off"] + best["len"]
+        if self._mmap is None or end_offset > len(self._mmap):
+            # Record mới được ghi sau lần map trước
+            self._close_map()
+            self._open_map()
+        rec = json.loads(zlib.decompress(self._mmap[best["off"]:end_offset]))
+        if span is not None:
+            rec["body"] = trim_daily(rec["body"], *span)
+        return rec
+
+    def record(self, url: httpx.URL, status_code: int, content_type: str, body: bytes) -> None:
+        """
+        Nối một record vào cuối file. Index được ghi sau mỗi
+        SNAPSHOT_FLUSH_EVERY record, chậm nhất SNAPSHOT_FLUSH_SECONDS giây
+        sau record chưa ghi đầu tiên, và khi gọi flush()/close().
+        Hàm chạy I/O đồng bộ: gọi qua asyncio.to_thread từ event loop.
+        Không làm gì nếu snapshot chỉ đọc.
+        """
+        if not self.writable:
+            return
+        key, lat, lon, span = describe_request(url)
+        if span is not None:
+            t0, t1 = float(span[0].toordinal()), float(span[1].toordinal())
+        else:
+            t0 = t1 = _days_now()
+        blob = zlib.compress(json.dumps({
+            "url": str(url),
+            "status": status_code,
+            "content_type": content_type,
+            "body": body.decode("utf-8", errors="replace"),
+        }, ensure_ascii=False).encode("utf-8"))
+
+        with self._lock:
+            if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+                with open(self.path, "wb") as f:
+                    f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, 0, 0))
+            with open(self.path, "r+b") as f:
+                off = f.seek(0, os.SEEK_END)
+                f.write(blob)
+            entry = {
+                "key": key, "lat": lat, "lon": lon, "t0": t0, "t1": t1,
+                "off": off, "len": len(blob),
+            }
+            self._entries.setdefault(key, []).append(entry)
+            self._unindexed.append(entry)
+            if len(self._unindexed) >= SNAPSHOT_FLUSH_EVERY:
+                self._flush_locked()
+            elif self._flush_timer is None:
+                self._flush_timer = threading.Timer(SNAPSHOT_FLUSH_SECONDS, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def _flush_locked(self) -> None:
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if not self._unindexed:
+            return
+        segment = zlib.compress(json.dumps({
+            "prev": list(self._head) if self._head[1] else None,
+            "entries": self._unindexed,
+        }).encode("utf-8"))
+        with open(self.path, "r+b") as f:
+            segment_offset = f.seek(0, os.SEEK_END)
+            f.write(segment)
+            f.flush()
+            os.fsync(f.fileno())
+            # Chỉ trỏ header sang đoạn mới khi đoạn đó đã nằm trên đĩa
+            f.seek(0)
+            f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, segment_offset, len(segment)))
+            f.flush()
+            os.fsync(f.fileno())
+        self._head = (segment_offset, len(segment))
+        self._segments += 1
+        self._unindexed = []
+
+    def _compact_locked(self) -> None:
+        """Ghi lại các record cùng một đoạn index duy nhất vào file tạm rồi thay thế file cũ."""
+        entries = sorted(
+            (entry for entries in self._entries.values() for entry in entries),
+            key=lambda e: e["off"],
+        )
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(self.path, "rb") as src, open(tmp_path, "wb") as dst:
+                dst.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, 0, 0))
+                compacted = []
+                for entry in entries:
+                    src.seek(entry["off"])
+                    compacted.append({**entry, "off": dst.tell()})
+                    dst.write(src.read(entry["len"]))
+                segment = zlib.compress(json.dumps(
+                    {"prev": None, "entries": compacted}
+                ).encode("utf-8"))
+                segment_offset = dst.tell()
+                dst.write(segment)
+                dst.seek(0)
+                dst.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, segment_offset, len(segment)))
+                dst.flush()
+                os.fsync(dst.fileno())
+            self._close_map()
+            os.replace(tmp_path, self.path)
+        except OSError as exc:
+            # File cũ vẫn hợp lệ, chỉ là chưa được gộp
+            logger.warning("Không gộp được snapshot %s: %s", self.path, exc)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        self._entries = {}
+        for entry in compacted:
+            self._entries.setdefault(entry["key"], []).append(entry)
+        self._head = (segment_offset, len(segment))
+        self._segments = 1
+
+    def flush(self) -> None:
+        """Ghi đoạn index cho các record chưa được flush."""
+        with self._lock:
+            self._flush_locked()
+
+    def close(self) -> None:
+        """Flush, gộp các đoạn index thành một và đóng mmap."""
+        with self._lock:
+            if self.writable:
+                self._flush_locked()
+                if self._segments > 1:
+                    self._compact_locked()
+            self._release_writer_lock()
+        self._close_map()
+
+
+class SnapshotTransport(httpx.AsyncBaseTransport):
+    """Transport httpx ghi / phát lại response theo SNAPSHOT_MODE."""
+
+    def __init__(self, snapshot: WeatherSnapshot, mode: str) -> None:
+        self.snapshot = snapshot
+        self.mode = mode
+        # Gửi qua một AsyncClient mặc định để giữ cấu hình proxy từ biến môi
+        # trường (HTTP(S)_PROXY, NO_PROXY); httpx bỏ qua các biến này khi
+        # client được tạo với transport tùy chỉnh như SnapshotTransport.
+        self._upstream = httpx.AsyncClient()
+
+    def _replay(
+        self, request: httpx.Request, max_age_hours: float | None = None
+    ) -> httpx.Response | None:
+        rec = self.snapshot.lookup(request.url, max_age_hours)
+        if rec is None:
+            return None
+        return httpx.Response(
+            rec["status"],
+            headers={"content-type": rec["content_type"]},
+            content=rec["body"].encode("utf-8"),
+            request=request,
+        )
+
+    def _fallback(self, request: httpx.Request) -> httpx.Response | None:
+        if self.mode != "fallback":
+            return None
+        return self._replay(request, SNAPSHOT_FALLBACK_MAX_AGE_HOURS)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if self.mode == "replay":
+            response = self._replay(request)
+            if response is None:
+                raise httpx.ConnectError(
+                    f"Không có dữ liệu snapshot phù hợp cho {request.url}", request=request
+                )
+            return response
+
+        try:
+            upstream = await self._upstream.send(request)
+            body = upstream.content
+        except httpx.TransportError:
+            if (response := self._fallback(request)) is not None:
+                return response
+            raise
+
+        if upstream.status_code >= 500:
+            if (response := self._fallback(request)) is not None:
+                return response
+        else:
+            try:
+                await asyncio.to_thread(
+                    self.snapshot.record, request.url, upstream.status_code,
+                    upstream.headers.get("content-type", "application/json"), body,
+                )
+            except OSError as exc:
+                # Ghi snapshot chỉ là tác dụng phụ, không làm hỏng response từ upstream
+                logger.warning("Không ghi được snapshot %s: %s", self.snapshot.path, exc)
+
+        # body đã được giải nén nên bỏ content-encoding / content-length gốc
+        return httpx.Response(
+            upstream.status_code,
+            headers={"content-type": upstream.headers.get("content-type", "application/json")},
+            content=body,
+            request=request,
+        )
+
+    async def aclose(self) -> None:
+        await self._upstream.aclose()
+
+
+if SNAPSHOT_MODE not in SNAPSHOT_MODES:
+    raise ValueError(
+        f"WEATHER_SNAPSHOT_MODE không hợp lệ: '{SNAPSHOT_MODE}'. "
+        f"Giá trị hợp lệ: {', '.join(SNAPSHOT_MODES)}"
+    )
+if SNAPSHOT_MODE == "replay" and not os.path.exists(SNAPSHOT_PATH):
+    raise FileNotFoundError(f"Không tìm thấy file snapshot: {SNAPSHOT_PATH}")
+
+snapshot = (
+    WeatherSnapshot(SNAPSHOT_PATH, writable=SNAPSHOT_MODE in ("record", "fallback"))
+    if SNAPSHOT_MODE != "off" else None
+)
+if snapshot is not None:
+    atexit.register(snapshot.close)
+
+
+def http_client(timeout: float) -> httpx.AsyncClient:
+    """Tạo AsyncClient gọi Open-Meteo, đi qua snapshot nếu được bật."""
+    if snapshot is None:
+        return httpx.AsyncClient(timeout=timeout)
+    return httpx.AsyncClient(timeout=timeout, transport=SnapshotTransport(snapshot, SNAPSHOT_MODE))
+
+
 # ─── Tool 1: Tìm tọa độ thành phố ──────────────────────────────────────────
 @mcp.tool()
+@scheduled(PRIORITY_CHEAP)
 async def geocode_city(city_name: str) -> str:
     """
     Tìm tọa độ địa lý (latitude, longitude) của một thành phố.
@@ -100,7 +793,7 @@ async def geocode_city(city_name: str) -> str:
         "format": "json",
     }
 
-    async with httpx.AsyncClient(timeout=10) as client:
+    async with http_client(timeout=10) as client:
         resp = await client.get(url, params=params)
         resp.raise_for_status()
         data = resp.json()
@@ -134,6 +827,7 @@ async def geocode_city(city_name: str) -> str:
 
 # ─── Tool 2: Thời tiết hiện tại ─────────────────────────────────────────────
 @mcp.tool()
+@scheduled(PRIORITY_NORMAL)
 async def get_current_weather(latitude: float, longitude: float) -> str:
     """
     Lấy thông tin thời tiết hiện tại tại vị trí cho trước.
@@ -171,7 +865,7 @@ async def get_current_weather(latitude: float, longitude: float) -> str:
         "timezone": "auto",
     }
 
-    async with httpx.AsyncClient(timeout=10) as client:
+    async with http_client(timeout=10) as client:
         resp = await client.get(url, params=params)
         resp.raise_for_status()
         data = resp.json()
@@ -225,6 +919,7 @@ async def get_current_weather(latitude: float, longitude: float) -> str:
 
 # ─── Tool 3: Dự báo thời tiết ───────────────────────────────────────────────
 @mcp.tool()
+@scheduled(PRIORITY_NORMAL)
 async def get_forecast(latitude: float, longitude: float, days: int = 7) -> str:
     """
     Lấy dự báo thời tiết theo ngày trong tối đa 7 ngày tới.
@@ -266,7 +961,7 @@ async def get_forecast(latitude: float, longitude: float, days: int = 7) -> str:
         "timezone": "auto",
     }
 
-    async with httpx.AsyncClient(timeout=10) as client:
+    async with http_client(timeout=10) as client:
         resp = await client.get(url, params=params)
         resp.raise_for_status()
         data = resp.json()
@@ -336,6 +1031,7 @@ async def get_forecast(latitude: float, longitude: float, days: int = 7) -> str:
 
 # ─── Tool 4: Thời tiết theo tên thành phố (1 bước) ─────────────────────────
 @mcp.tool()
+@scheduled(PRIORITY_NORMAL)
 async def get_weather_by_city(city_name: str) -> str:
     """
     Lấy thời tiết hiện tại bằng tên thành phố (không cần nhập tọa độ thủ công).
@@ -351,7 +1047,7 @@ async def get_weather_by_city(city_name: str) -> str:
     geo_url = "https://geocoding-api.open-meteo.com/v1/search"
     geo_params = {"name": city_name, "count": 1, "language": "vi", "format": "json"}
 
-    async with httpx.AsyncClient(timeout=10) as client:
+    async with http_client(timeout=10) as client:
         geo_resp = await client.get(geo_url, params=geo_params)
         geo_resp.raise_for_status()
         geo_data = geo_resp.json()
@@ -386,7 +1082,7 @@ async def get_weather_by_city(city_name: str) -> str:
         "timezone": "auto",
     }
 
-    async with httpx.AsyncClient(timeout=10) as client:
+    async with http_client(timeout=10) as client:
         wx_resp = await client.get(wx_url, params=wx_params)
         wx_resp.raise_for_status()
         wx_data = wx_resp.json()
@@ -437,6 +1133,7 @@ async def get_weather_by_city(city_name: str) -> str:
 
 # ─── Tool 5: Chất lượng không khí ───────────────────────────────────────────
 @mcp.tool()
+@scheduled(PRIORITY_NORMAL)
 async def get_air_quality(city_name: str) -> str:
     """
     Lấy chỉ số chất lượng không khí hiện tại của một thành phố.
@@ -450,7 +1147,7 @@ async def get_air_quality(city_name: str) -> str:
     """
     # Bước 1: Geocode
     geo_url = "https://geocoding-api.open-meteo.com/v1/search"
-    async with httpx.AsyncClient(timeout=10) as client:
+    async with http_client(timeout=10) as client:
         geo_resp = await client.get(geo_url, params={"name": city_name, "count": 1, "format": "json"})
         geo_resp.raise_for_status()
         geo_data = geo_resp.json()
@@ -478,7 +1175,7 @@ async def get_air_quality(city_name: str) -> str:
         "timezone": "auto",
     }
 
-    async with httpx.AsyncClient(timeout=10) as client:
+    async with http_client(timeout=10) as client:
         aq_resp = await client.get(aq_url, params=aq_params)
         aq_resp.raise_for_status()
         aq_data = aq_resp.json()
@@ -534,6 +1231,7 @@ async def get_air_quality(city_name: str) -> str:
 
 # ─── Tool 6: Thời tiết lịch sử ──────────────────────────────────────────────
 @mcp.tool()
+@scheduled(PRIORITY_EXPENSIVE)
 async def get_historical_weather(
     city_name: str,
     start_date: str,
@@ -565,7 +1263,7 @@ async def get_historical_weather(
 
     # Bước 1: Geocode
     geo_url = "https://geocoding-api.open-meteo.com/v1/search"
-    async with httpx.AsyncClient(timeout=10) as client:
+    async with http_client(timeout=10) as client:
         geo_resp = await client.get(geo_url, params={"name": city_name, "count": 1, "format": "json"})
         geo_resp.raise_for_status()
         geo_data = geo_resp.json()
@@ -606,7 +1304,7 @@ async def get_historical_weather(
         "timezone": "auto",
     }
 
-    async with httpx.AsyncClient(timeout=15) as client:
+    async with http_client(timeout=15) as client:
         hist_resp = await client.get(hist_url, params=hist_params)
         if hist_resp.status_code == 400:
             err_json = hist_resp.json()